@@ -29,14 +29,16 @@
 # OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 import argparse
-from io import open
 import sys
 import math
 import numpy as np
+from scipy.linalg import solveh_banded
 import svgwrite
 
 def bspl_kern(x):
-    '''Cubic B-spline kernel and first derivative kernel'''
+    '''Cubic B-spline kernel and first derivative kernel. Works
+    elementwise, so x may be a scalar or an ndarray of parameter
+    values.'''
     a = 0.5 * x
     b = a * x
     c = b * x
@@ -52,8 +54,11 @@ def bspl_kern(x):
     d2 = ((1. - 3. * x2) / 2. + x)
     d3 = b
 
-    return [ k0, k1, k2, k3], [d0, d1, d2, d3]
+    return np.array([ k0, k1, k2, k3]), np.array([d0, d1, d2, d3])
 
+# The ease function is applied once to the whole array of normalized
+# cam angles, not per sample, so custom ease functions must operate
+# elementwise on ndarrays.
 def ease_linear(x):
     return x
 
@@ -73,13 +78,8 @@ def fit_cam(min_angle, max_angle, r_base, disp, n_seg = 12, n_samp_per_seg = 50,
     a_max = deg2rad(max_angle)
     n_samp_total = n_seg * n_samp_per_seg
     n_par = 2 * (n_seg + 3)
-    y_coeff_off = n_seg + 3
-    
-    A = np.zeros([2 * n_samp_total, n_par])
-    B = np.zeros([2 * n_samp_total])
-    
+
     n_inv_seg = 1.0 / n_samp_per_seg
-    n_inv_ang = 1.0 / (n_samp_total - 1)
 
     # The spline coefficients are determined using a linear least
     # squares method. The cam pushes against a vertical wall. For a
@@ -89,37 +89,63 @@ def fit_cam(min_angle, max_angle, r_base, disp, n_seg = 12, n_samp_per_seg = 50,
     # sense. The second constraint is on the derivative of the
     # spline. Since the wall is vertical, the derivative in x must be
     # zero, i.e., the cam tangent must be parallel to the wall.
-    idx = 0
-    for seg in range(n_seg):
-        for i in range(n_samp_per_seg):
-            q = n_inv_ang * idx
-            qq = ease_func(q)
-            t = n_inv_seg * i
-    
-            k, d = bspl_kern(t)
-    
-            theta = a_min + q * (a_max - a_min)
-            c = math.cos(theta)
-            s = math.sin(theta)
-            h = r_base + disp * qq
+    #
+    # Each sample only touches the four coefficients of its segment.
+    # The x- and y-coefficients are interleaved per basis function
+    # (x_m at column 2m, y_m at column 2m+1), so each constraint row
+    # has its at most 8 nonzeros in the contiguous column range
+    # 2*seg..2*seg+7 and the Gram matrix of the system is banded with
+    # 7 off-diagonals. Note that the x- and y-blocks do not decouple:
+    # the cross terms carry a factor cos*sin that only cancels for
+    # special angle ranges.
+    q = np.linspace(0.0, 1.0, n_samp_total)
+    qq = ease_func(q)
+    # The spline parameter t only depends on the sample position
+    # within a segment, so there are just n_samp_per_seg distinct
+    # kernel values; evaluate them once and share them across the
+    # segments.
+    t = n_inv_seg * np.arange(n_samp_per_seg)
+    k_seg, d_seg = bspl_kern(t)
+
+    theta = np.linspace(a_min, a_max, n_samp_total)
+    c = np.cos(theta)
+    s = np.sin(theta)
+    h = r_base + disp * qq
+
+    # Accumulate the normal equations segment by segment instead of
+    # materializing the tall constraint matrix. A segment contributes
+    # a dense (2*n_samp_per_seg, 8) block whose displacement rows hold
+    # c*k and s*k and whose slope rows (derivative in x must be zero)
+    # hold c*d and s*d; its Gram contribution is an 8x8 window on the
+    # band of the normal matrix. The working set per segment is a few
+    # kilobytes, so the accumulation stays cache-resident even for
+    # very large --segments/--samples runs.
+    bw = 7
+    ab = np.zeros([bw + 1, n_par])
+    Atb = np.zeros(n_par)
+    blk = np.empty([2 * n_samp_per_seg, 8])
+    b_blk = np.zeros(2 * n_samp_per_seg)
+    for m in range(n_seg):
+        sl = slice(m * n_samp_per_seg, (m + 1) * n_samp_per_seg)
+        blk[0::2, 0::2] = c[sl][:, None] * k_seg.T
+        blk[0::2, 1::2] = s[sl][:, None] * k_seg.T
+        blk[1::2, 0::2] = c[sl][:, None] * d_seg.T
+        blk[1::2, 1::2] = s[sl][:, None] * d_seg.T
+        b_blk[0::2] = h[sl]
+
+        G = blk.T @ blk
+        o = 2 * m
+        for i in range(bw + 1):
+            ab[bw - i, o + i:o + 8] += np.diagonal(G, i)
+        Atb[o:o + 8] += blk.T @ b_blk
 
-            # Displacement constraint
-            for j in range(4):
-                A[2 * idx, seg + j] = c * k[j]
-                A[2 * idx, y_coeff_off + seg + j] = s * k[j]
-            B[2 * idx] = h
-            # Constraint on the slope, i.e., the derivative in x
-            # must be zero
-            for j in range(4):
-                A[2 * idx + 1, seg + j] = c * d[j]
-                A[2 * idx + 1, y_coeff_off + seg + j] = s * d[j]
-            B[2 * idx + 1] = 0
-            idx += 1
+    # Solve via the normal equations. The Gram matrix is well
+    # conditioned and, thanks to the interleaved coefficient ordering,
+    # a symmetric band matrix, so a banded Cholesky factorization is
+    # much cheaper than an SVD or iterative solve on the tall system.
+    B = solveh_banded(ab, Atb, check_finite=False)
 
-    # Solve equation system
-    B = np.linalg.lstsq(A, B, rcond=-1)[0]
-            
-    C = B.reshape([2, n_seg + 3]).T
+    C = B.reshape([n_seg + 3, 2])
 
     # Evaluate the error and compute friction coefficient required for
     # the cam to lock. The clamping force generated by the cam is
@@ -128,67 +154,37 @@ def fit_cam(min_angle, max_angle, r_base, disp, n_seg = 12, n_samp_per_seg = 50,
     # by the y-coordinate. For the cam to lock, the friction force
     # must be high enough to generate a corresponding moment μ*F*x,
     # i.e., μ >= y/x.
-    err = 0.0
-    idx = 0
+    #
+    # The angles, cos/sin values and kernel evaluations from the
+    # assembly above are reused here, so the samples are traversed
+    # only once overall.
+    # A sliding window over the control polygon gives the four
+    # coefficients of every segment; one batched product with the
+    # shared kernel matrix then evaluates the spline at all samples.
+    Cw = np.lib.stride_tricks.sliding_window_view(C, 4, axis=0)
+    cam_pts = np.einsum('ji,sdj->sid', k_seg, Cw).reshape(n_samp_total, 2)
 
-    cam_pts = np.zeros([n_samp_total, 2])
-    friction = np.zeros([n_samp_total, 2])
-    for seg in range(n_seg):
-        for i in range(n_samp_per_seg):
-            q = n_inv_ang * idx
-            qq = ease_func(q)
-            t = n_inv_seg * i
-    
-            k, d = bspl_kern(t)
-    
-            theta = a_min + q * (a_max - a_min)
-            c = math.cos(theta)
-            s = math.sin(theta)
-            h = r_base + disp * qq
-    
-            x = 0
-            y = 0
-            p = [0, 0]
-            for j in range(4):
-                p += k[j] * C[seg+j]
-
-            cam_pts[idx] = p
-            
-            x = p[0]
-            y = p[1]
-            x1 = c * x + s * y
-            y1 = -s * x + c * y
-            err += (h - x1) * (h - x1)
-            f = y1 / x1
+    x1 = c * cam_pts[:, 0] + s * cam_pts[:, 1]
+    y1 = -s * cam_pts[:, 0] + c * cam_pts[:, 1]
 
-            friction[idx] = [rad2deg(theta), f]
-            idx += 1
-
-    err = math.sqrt(err / n_samp_total)
+    err = math.sqrt(np.mean((h - x1) ** 2))
+    friction = np.column_stack([rad2deg(theta), y1 / x1])
     return C, err, cam_pts, friction
 
 def spl2bez(B, scale = 1.0):
     '''This function converts a cubic B-spline to a Bezier curve'''
-    Q = []
-    for i in range(B.shape[0] - 3):
-        q = np.zeros([4, 2])
-        c = [ scale * B[i+j] for j in range(4) ]
-        # Gather powers to obtain q0 + q1 * t + q2 * t^2 + q3 * t^3
-        q[0] =  c[0] / 6.0 + 2.0 * c[1] / 3.0 + c[2] / 6.0
-        q[1] = -c[0] / 2.0 + c[2] / 2.0
-        q[2] =  c[0] / 2.0 - c[1] + c[2] / 2.0
-        q[3] = -c[0] / 6.0 + c[1] / 2.0 - c[2] / 2.0 + c[3] / 6.0
-        # Convert to bezier using binomial coefficients
-        c[0] = q[0]
-        c[1] = q[0] + 1.0 / 3.0 * q[1]
-        c[2] = q[0] + 2.0 / 3.0 * q[1] + 1.0 / 3.0 * q[2]
-        c[3] = q[0] + q[1] + q[2] + q[3]
-        if not i:
-            Q.append(c[0])
-        Q.append(c[1])
-        Q.append(c[2])
-        Q.append(c[3])
-    return Q
+    # The conversion is a fixed basis change (B-spline to Bernstein)
+    # of the four control points of each segment, i.e., one 4x4
+    # matrix applied to a sliding window over the control points.
+    M = np.array([[1.0, 4.0, 1.0, 0.0],
+                  [0.0, 4.0, 2.0, 0.0],
+                  [0.0, 2.0, 4.0, 0.0],
+                  [0.0, 1.0, 4.0, 1.0]]) / 6.0
+    win = np.lib.stride_tricks.sliding_window_view(B, 4, axis=0)
+    bez = scale * np.einsum('ij,sdj->sid', M, win)
+    # Adjacent segments share their boundary point, so the first
+    # Bezier point is only kept for the first segment.
+    return np.concatenate([bez[:1, 0], bez[:, 1:].reshape(-1, 2)])
 
 __desc__ = '''This program computes a cam shape for a given base
 radius, displacement and range of rotation angles.'''
@@ -233,23 +229,18 @@ if __name__ == '__main__':
     print("RMS error: {}".format(err), file=sys.stderr)
 
     if args.pts:
-        f = open(args.pts, 'w')
-        for p in pts:
-            print('{} {}'.format(p[0], p[1]), file=f)
-        f.close()
-    
+        np.savetxt(args.pts, pts, fmt='%.17g')
+
     if args.friction:
-        f = open(args.friction, 'w')
-        for p in friction:
-            print('{} {}'.format(p[0], p[1]), file=f)
-        f.close()
+        np.savetxt(args.friction, friction, fmt='%.17g')
 
     if len(Q):
-        p = 'M{},{}'.format(ox + Q[0][0], oy - Q[0][1])
+        parts = [f'M{ox + Q[0][0]},{oy - Q[0][1]}']
         for i in range(1, len(Q), 3):
-            p += ' C{},{}, {},{}, {}, {}'.format(ox + Q[i][0], oy - Q[i][1],
-                                                   ox + Q[i+1][0], oy- Q[i+1][1],
-                                                   ox + Q[i+2][0], oy - Q[i+2][1])
+            parts.append(f' C{ox + Q[i][0]},{oy - Q[i][1]},'
+                         f' {ox + Q[i+1][0]},{oy - Q[i+1][1]},'
+                         f' {ox + Q[i+2][0]}, {oy - Q[i+2][1]}')
+        p = ''.join(parts)
         svg = svgwrite.Drawing(args.output, profile='full', size=(8.5*svgwrite.inch, 11*svgwrite.inch))
         svg.add(svg.path( d=p, stroke=svgwrite.rgb(0, 0, 0, '%'),
                               fill='none',